@@ -1,19 +1,35 @@
 import os
+import re
 import time
 import uuid
+import orjson
+import base64
+import hashlib
+import functools
+import asyncio
 import tempfile
-from fastapi import FastAPI
+import itertools
+import pathlib
+import httpx
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from fastapi import Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 import traceback
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from dotenv import load_dotenv
+import diskcache
 
-from google import genai
-from google.genai import types
+try:
+    from google.cloud import texttospeech
+except ImportError:
+    texttospeech = None
 
 # ======================================
 # Load API Key
@@ -23,6 +39,18 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 RUNWAY_API_KEY = os.getenv("RUNWAY_API_KEY")
 EDEN_API_KEY = os.getenv("EDEN_API_KEY")
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "/usr/bin/ffmpeg")
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", os.path.join(os.path.dirname(FFMPEG_PATH), "ffprobe"))
+# auto | nvenc | vaapi | x264
+HWENC = os.getenv("HWENC", "auto")
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128")
+# "local" = keyword check in-process, "gemini" = full Gemini review
+COMPLIANCE_MODE = os.getenv("COMPLIANCE_MODE", "local")
+
+# Public base for generated files, resolved once at boot
+RENDER_EXTERNAL_HOSTNAME = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+VIDEO_BASE_URL = (
+    f"https://{RENDER_EXTERNAL_HOSTNAME}/videos" if RENDER_EXTERNAL_HOSTNAME else "/videos"
+)
 
 if not GEMINI_API_KEY:
     print("⚠️ Missing GEMINI_API_KEY")
@@ -30,11 +58,16 @@ if not RUNWAY_API_KEY:
     print("⚠️ Missing RUNWAY_API_KEY")
 if not EDEN_API_KEY:
     print("⚠️ Missing EDEN_API_KEY")
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-client = genai.Client(api_key=GOOGLE_API_KEY)
+# Direct Google Cloud TTS when service-account credentials are configured,
+# otherwise audio goes through EdenAI
+tts_client = None
+if texttospeech and os.getenv("GOOGLE_APPLICATION_CREDENTIALS"):
+    tts_client = texttospeech.TextToSpeechClient()
+else:
+    print("⚠️ Google Cloud TTS not configured — using EdenAI for audio")
 
-app = FastAPI(title="MedTech AI (Gemini + VEO3)")
+app = FastAPI(title="MedTech AI (Gemini + VEO3)", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -44,8 +77,192 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-temp_dir = tempfile.gettempdir()
-app.mount("/videos", StaticFiles(directory=temp_dir), name="videos")
+# Everything the app writes lives in its own directory, so pruning never
+# touches other programs' files in the shared temp dir
+temp_dir = os.path.join(tempfile.gettempdir(), "medtech")
+os.makedirs(temp_dir, exist_ok=True)
+
+# Intermediate files only need to be unique on this box: pid + process start
+# time + a counter, instead of reading urandom for a uuid on every file
+TEMP_PREFIX = f"{os.getpid()}_{int(time.time())}"
+TEMP_COUNTER = itertools.count()
+
+
+def temp_path(prefix, ext):
+    return os.path.join(temp_dir, f"{prefix}_{TEMP_PREFIX}_{next(TEMP_COUNTER)}.{ext}")
+
+# Finished /generate responses, keyed by the normalized request
+CACHE = diskcache.Cache(os.path.join(temp_dir, "cache"))
+CACHE_TTL = 7 * 24 * 3600
+
+# Background video jobs — on disk so every uvicorn worker sees the same state
+JOBS = diskcache.Cache(os.path.join(temp_dir, "jobs"))
+JOB_TTL = 24 * 3600
+
+# Generated media older than this is removed at startup and then daily
+MEDIA_RETENTION_DAYS = int(os.getenv("MEDIA_RETENTION_DAYS", "7"))
+MEDIA_PREFIXES = ("final_", "sub_", "audio_")
+PRUNE_INTERVAL = 24 * 3600
+
+
+# ======================================
+# Generated media (/videos)
+# ======================================
+# Only finished outputs are servable — never anything else in the temp dir
+MEDIA_NAME_RE = re.compile(r"(?:final|sub)_[0-9a-f]+\.(?:mp4|vtt)")
+MEDIA_TYPES = {".mp4": "video/mp4", ".vtt": "text/vtt"}
+# Final names are the script hash, but a pruned or missing file is rendered
+# again under the same name — revalidate against the ETag (mtime + size)
+# rather than caching forever
+MEDIA_HEADERS = {"Accept-Ranges": "bytes", "Cache-Control": "public, no-cache"}
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+def iter_file_range(path, start, end, chunk_size=1 << 16):
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+# HEAD too — players and link checkers probe media before fetching it
+@app.api_route("/videos/{name}", methods=["GET", "HEAD"])
+async def serve_media(name: str, request: Request):
+    if not MEDIA_NAME_RE.fullmatch(name):
+        raise HTTPException(status_code=404, detail="Not found")
+
+    path = os.path.join(temp_dir, name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    media_type = MEDIA_TYPES[os.path.splitext(name)[1]]
+    response = FileResponse(path, media_type=media_type, headers=MEDIA_HEADERS, stat_result=stat)
+    etag = response.headers["etag"]
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={**MEDIA_HEADERS, "ETag": etag})
+
+    # Seeking in <video> sends single-range requests; the pinned Starlette
+    # FileResponse has no Range support, so answer those with a 206 here
+    match = RANGE_RE.fullmatch(request.headers.get("range", "").strip())
+    if not match or match.groups() == ("", ""):
+        return response
+
+    size = stat.st_size
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(0, size - int(last)), size - 1
+    if start > end:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    headers = {
+        **MEDIA_HEADERS,
+        "ETag": etag,
+        "Content-Range": f"bytes {start}-{end}/{size}",
+        "Content-Length": str(end - start + 1),
+    }
+    if request.method == "HEAD":
+        return Response(status_code=206, media_type=media_type, headers=headers)
+    return StreamingResponse(
+        iter_file_range(path, start, end), status_code=206, media_type=media_type, headers=headers
+    )
+
+
+# ======================================
+# Shared async HTTP client (keep-alive + HTTP/2)
+# ======================================
+@app.on_event("startup")
+async def open_http_client():
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=120,
+        follow_redirects=True,
+        # Bodies are pre-serialized with orjson and sent as content=
+        headers={"Content-Type": "application/json"},
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+
+# Per-upstream (concurrency cap, requests-per-minute), per worker process
+GEMINI_LIMIT = (asyncio.Semaphore(8), AsyncLimiter(max_rate=60, time_period=60))
+RUNWAY_LIMIT = (asyncio.Semaphore(4), AsyncLimiter(max_rate=10, time_period=60))
+EDEN_LIMIT = (asyncio.Semaphore(8), AsyncLimiter(max_rate=60, time_period=60))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Submitting a Runway job is not idempotent: a 502/504 from a gateway may
+# still have started a paid render, so only answers that mean "not accepted"
+# are retried
+RUNWAY_SUBMIT_RETRY_STATUSES = {429, 503}
+RETRY_MAX_DELAY = 30
+backoff = wait_exponential_jitter(initial=1, max=RETRY_MAX_DELAY)
+
+
+def wait_retry_after(state):
+    retry_after = state.outcome.exception().response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(float(retry_after), RETRY_MAX_DELAY)
+    return backoff(state)
+
+
+# Retries throttled / 5xx answers, waiting for Retry-After when the upstream
+# sends one and jittered backoff otherwise; once attempts run out the last
+# response is handed back so callers report it as usual
+@retry(
+    retry=retry_if_exception_type(httpx.HTTPStatusError),
+    wait=wait_retry_after,
+    stop=stop_after_attempt(5),
+    retry_error_callback=lambda state: state.outcome.exception().response,
+)
+async def upstream_post(limit, url, retry_statuses=RETRY_STATUSES, **kwargs):
+    sem, limiter = limit
+    async with sem, limiter:
+        r = await app.state.http.post(url, **kwargs)
+    if r.status_code in retry_statuses:
+        raise httpx.HTTPStatusError(f"{r.status_code} from {url}", request=r.request, response=r)
+    return r
+
+
+# ======================================
+# Temp media pruning
+# ======================================
+def prune_media():
+    cutoff = time.time() - MEDIA_RETENTION_DAYS * 24 * 3600
+    removed = 0
+    with os.scandir(temp_dir) as entries:
+        for entry in entries:
+            if not entry.name.startswith(MEDIA_PREFIXES) or not entry.is_file():
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    print(f"🧹 Pruned {removed} media files older than {MEDIA_RETENTION_DAYS} days")
+
+
+async def prune_media_forever():
+    while True:
+        await asyncio.to_thread(prune_media)
+        await asyncio.sleep(PRUNE_INTERVAL)
+
+
+@app.on_event("startup")
+async def schedule_media_prune():
+    # Runs in the background so startup is not held up by a large temp dir
+    app.state.prune_task = asyncio.create_task(prune_media_forever())
 
 
 # GLOBAL EXCEPTION HANDLER — must be right here
@@ -68,62 +285,280 @@ class RequestData(BaseModel):
     device_name: str
     purpose: str
     language: str = "en"
+    # False: stream-copy the video and ship captions as a separate WebVTT track
+    burn_subtitles: bool = False
+
+
+# =============================================
+# STEP 1 — Research (approved reference content)
+# =============================================
+# Synchronous on purpose (a real source will be a blocking PubMed/SQL call);
+# async routes call it through asyncio.to_thread
+def fetch_research(device_name):
+    # Collapse whitespace so "  MRI " and "MRI" share one cache entry
+    return lookup_research(" ".join(device_name.split()))
+
+
+@functools.lru_cache(maxsize=4096)
+def lookup_research(device_name):
+    return (
+        f"{device_name} is a medical device. Approved talking points: its general "
+        f"purpose, where it is used, its basic working principle, and standard "
+        f"safety precautions. No diagnostic, treatment-outcome or efficacy claims."
+    )
 
 
 # ======================================
-# Step 1 — Gemini Script Generator
+# Gemini REST helper
 # ======================================
-def generate_script(device, purpose, lang):
-    prompt = f"""
-Write a 60-second medical explainer script about "{device}" 
-for the purpose "{purpose}".
-Tone: educational, simple.
-Language: {lang}.
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:streamGenerateContent?alt=sse"
+
+
+# Stable instructions travel as systemInstruction and sit ahead of the
+# per-request text, so every call shares a byte-identical prefix that
+# Gemini's implicit prompt caching can reuse.
+SCRIPT_GUIDELINES = """
+You write short medical device explainer scripts.
+Rules:
+- Only use facts from the approved research you are given.
+- No diagnostic, treatment-outcome or efficacy claims.
+- Tone: educational, simple.
+- Length: about 60 seconds of narration, plain prose, no headings.
 """
 
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-pro-latest:generateContent"
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {key}"}
+SCRIPT_WITH_REVIEW_GUIDELINES = SCRIPT_GUIDELINES + """
+Then review your own script as a medical compliance reviewer.
+Reply with JSON: {"script": "<the script>", "compliance": "YES" or "NO"}
+where compliance is YES only if every claim is supported by the approved research.
+"""
+
+COMPLIANCE_GUIDELINES = """
+You are a medical compliance reviewer.
+Given approved research and a script, decide whether the script only
+makes claims supported by the approved research.
+Answer with a single word: YES or NO.
+"""
+
+
+# Per-request prompt templates, built once at import
+SCRIPT_TEMPLATE = """
+Approved research:
+{research}
+
+Device: {device}
+Purpose: {purpose}
+Language: {language}
+"""
+
+BATCH_SCRIPT_TEMPLATE = """
+Return a JSON array of strings where element i is the script for item i.
+Each item carries its own approved research.
+Items:
+{items}
+"""
+
+COMPLIANCE_TEMPLATE = """
+Approved research:
+{research}
+
+Script:
+{script}
+"""
+
+
+def gemini_body(prompt, system_instruction=None, json_output=False):
     body = {"contents": [{"parts": [{"text": prompt}]}]}
+    if system_instruction:
+        body["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    if json_output:
+        body["generationConfig"] = {"responseMimeType": "application/json"}
+    return body
+
 
-    r = requests.post(url, json=body, headers=headers)
+async def call_gemini(prompt, key, system_instruction=None, json_output=False):
+    headers = {"x-goog-api-key": key}
+    body = gemini_body(prompt, system_instruction, json_output)
+
+    r = await upstream_post(GEMINI_LIMIT, GEMINI_URL, content=orjson.dumps(body), headers=headers)
     if r.status_code != 200:
         raise HTTPException(status_code=500, detail=f"Gemini Error: {r.text}")
 
-    return r.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt
-    )
-    return response.text
+    return orjson.loads(r.content)["candidates"][0]["content"]["parts"][0]["text"].strip()
+
+
+async def stream_gemini(prompt, key, system_instruction=None):
+    headers = {"x-goog-api-key": key}
+    body = gemini_body(prompt, system_instruction)
+
+    sem, limiter = GEMINI_LIMIT
+    async with sem, limiter:
+        async with app.state.http.stream(
+            "POST", GEMINI_STREAM_URL, content=orjson.dumps(body), headers=headers
+        ) as r:
+            if r.status_code != 200:
+                await r.aread()
+                raise HTTPException(status_code=500, detail=f"Gemini Error: {r.text}")
+
+            # Each SSE "data:" line is a partial GenerateContentResponse
+            async for line in r.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                chunk = orjson.loads(line[len("data: "):])
+                for candidate in chunk.get("candidates", [])[:1]:
+                    for part in candidate.get("content", {}).get("parts", []):
+                        if part.get("text"):
+                            yield part["text"]
 
 
 # ======================================
-# Step 2 — VEO 3.1 Video + Audio Generation
+# Step 2 — Gemini Script Generator
 # ======================================
-def generate_video_with_audio(prompt_text):
+# Returns (script, compliance). In "gemini" compliance mode the review is fused
+# into the same call; otherwise compliance is None and is checked afterwards.
+def script_cache_key(device, purpose, research, lang):
+    raw = "|".join(part.strip().lower() for part in (device, purpose, lang))
+    return "script:" + hashlib.blake2b(f"{raw}|{COMPLIANCE_MODE}|{research}".encode()).hexdigest()
 
-    operation = client.models.generate_videos(
-        model="veo-3.1-generate-preview",
-        prompt=prompt_text,
-        config=types.GenerateVideosConfig(
-            duration_seconds=8
-        )
+
+async def generate_script(device, purpose, research, lang, key):
+    # Scripts are cached apart from full responses, so a re-run after the video
+    # expired (or with other subtitle settings) skips Gemini entirely
+    cache_key = script_cache_key(device, purpose, research, lang)
+    cached = CACHE.get(cache_key)
+    if cached:
+        return cached
+
+    result = await request_script(device, purpose, research, lang, key)
+    # In "gemini" mode a missing review means the fused reply was unusable;
+    # leave it uncached so the next request tries the fused call again
+    if COMPLIANCE_MODE != "gemini" or result[1] is not None:
+        CACHE.set(cache_key, result, expire=CACHE_TTL)
+    return result
+
+
+async def request_script(device, purpose, research, lang, key):
+    prompt = SCRIPT_TEMPLATE.format(research=research, device=device, purpose=purpose, language=lang)
+    if COMPLIANCE_MODE != "gemini":
+        return await call_gemini(prompt, key, SCRIPT_GUIDELINES), None
+
+    text = await call_gemini(prompt, key, SCRIPT_WITH_REVIEW_GUIDELINES, json_output=True)
+    try:
+        reply = orjson.loads(text)
+    except ValueError:
+        reply = None
+
+    script = reply.get("script") if isinstance(reply, dict) else None
+    if not isinstance(script, str) or not script.strip():
+        # No usable script in the reply — never narrate the raw JSON, ask again
+        # for a plain script and review it separately
+        return await call_gemini(prompt, key, SCRIPT_GUIDELINES), None
+
+    compliance = reply.get("compliance")
+    if not isinstance(compliance, str):
+        return script.strip(), None
+    return script.strip(), compliance.strip().upper().startswith("YES")
+
+
+async def generate_scripts_batch(items, researches, key):
+    # One prompt for the whole batch: the guideline prefix is paid once
+    batch = [
+        {
+            "device": item.device_name,
+            "purpose": item.purpose,
+            "language": item.language,
+            "research": research,
+        }
+        for item, research in zip(items, researches)
+    ]
+    prompt = BATCH_SCRIPT_TEMPLATE.format(items=orjson.dumps(batch).decode())
+    text = await call_gemini(prompt, key, SCRIPT_GUIDELINES, json_output=True)
+
+    # None marks an item the caller should regenerate on its own
+    try:
+        scripts = orjson.loads(text)
+    except ValueError:
+        return [None] * len(items)
+    if not isinstance(scripts, list) or len(scripts) != len(items):
+        return [None] * len(items)
+    return [s.strip() if isinstance(s, str) and s.strip() else None for s in scripts]
+
+
+# ======================================
+# Step 3 — Gemini Compliance Check
+# ======================================
+# Claim phrases that need explicit backing in the approved research
+UNSUPPORTED_CLAIM_RE = re.compile(
+    r"\b(?:cures?|cured|guarantee[sd]?|risk[- ]free|miracle|no side effects"
+    r"|clinically proven|prevents?|eliminates?|best treatment)\b|\b100\s?%",
+    re.IGNORECASE,
+)
+
+
+def local_compliance(script, research):
+    research_lower = research.lower()
+    return all(
+        match.group(0).lower() in research_lower
+        for match in UNSUPPORTED_CLAIM_RE.finditer(script)
     )
 
-    # Poll slowly to avoid 429
-    while not operation.done:
-        print("⏳ Waiting for VEO... (poll every 15s)")
-        time.sleep(15)
-        operation = client.operations.get(operation.name)
 
-    result = operation.response.generated_videos[0]
-    video_file = result.video
+# Share of the research's content words the script must reuse for a script that
+# also passes the local claim check to skip the Gemini review. On sample
+# scripts against the stub research, on-topic English ones reuse 0.50-0.57,
+# generic filler 0.20, off-topic and non-English ones 0.05 or less.
+COMPLIANCE_SHORTCUT_RATIO = float(os.getenv("COMPLIANCE_SHORTCUT_RATIO", "0.3"))
+WORD_RE = re.compile(r"\w+")
+STOPWORDS = frozenset("""
+the and are for its was were with that this from has have had which where when how
+can not but our your you they their them there into also than then these those such
+any all each will would could should may might been being who what why about over
+under more most other some only very just one two per via upon
+""".split())
+
+
+def content_words(text):
+    return {w for w in WORD_RE.findall(text.lower()) if len(w) > 2 and w not in STOPWORDS}
+
+
+def research_overlap(script, research):
+    terms = content_words(research)
+    return len(terms & content_words(script)) / (len(terms) or 1)
+
+
+async def validate_compliance(script, research, key):
+    if COMPLIANCE_MODE != "gemini":
+        return local_compliance(script, research)
+
+    if local_compliance(script, research):
+        ratio = research_overlap(script, research)
+        if ratio > COMPLIANCE_SHORTCUT_RATIO:
+            print(f"✅ Compliance shortcut (overlap {ratio:.3f})")
+            return True
+        print(f"🔎 Compliance sent to Gemini (overlap {ratio:.3f})")
+    else:
+        print("🔎 Compliance sent to Gemini (unsupported claim phrase)")
+
+    prompt = COMPLIANCE_TEMPLATE.format(research=research, script=script)
+    answer = await call_gemini(prompt, key, COMPLIANCE_GUIDELINES)
+    return answer.upper().startswith("YES")
+
+
+# =============================================
+# STEP 4 — Runway Gen-2 Video
+# =============================================
+RUNWAY_URL = "https://api.runwayml.com/v1/generate"
+RUNWAY_TASKS_URL = "https://api.runwayml.com/v1/tasks"
+RUNWAY_POLL_MAX_DELAY = 8
+RUNWAY_MAX_WAIT = 300
+
+
+def runway_video_url(output):
+    first = output[0]
+    return first["video"] if isinstance(first, dict) else first
 
-    output_path = os.path.join(temp_dir, f"veo_{uuid.uuid4().hex}.mp4")
-    client.files.download(video_file)
-    video_file.save(output_path)
 
-    return output_path
+async def generate_gen2_video(prompt, key):
 
     payload = {
         "model": "gen2",
@@ -133,23 +568,90 @@ def generate_video_with_audio(prompt_text):
         "resolution": "1080p"
     }
 
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json"
-    }
+    headers = {"Authorization": f"Bearer {key}"}
 
-    r = requests.post(url, json=payload, headers=headers)
+    r = await upstream_post(
+        RUNWAY_LIMIT, RUNWAY_URL, RUNWAY_SUBMIT_RETRY_STATUSES,
+        content=orjson.dumps(payload), headers=headers,
+    )
     if r.status_code != 200:
         raise HTTPException(status_code=500, detail=f"Runway Error: {r.text}")
 
-    return r.json()["output"][0]["video"]
+    task = orjson.loads(r.content)
+    if task.get("output"):
+        return runway_video_url(task["output"])
+
+    # Submitted as a task — poll with backoff (1s, 1.5s, 2.25s... capped at 8s),
+    # yielding the event loop between checks
+    delay = 1.0
+    waited = 0.0
+    while waited < RUNWAY_MAX_WAIT:
+        await asyncio.sleep(delay)
+        waited += delay
+
+        r = await app.state.http.get(f"{RUNWAY_TASKS_URL}/{task['id']}", headers=headers)
+        if r.status_code == 429 or r.status_code >= 500:
+            retry_after = r.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else min(delay * 1.5, RUNWAY_POLL_MAX_DELAY)
+            continue
+        if r.status_code != 200:
+            raise HTTPException(status_code=500, detail=f"Runway Error: {r.text}")
+
+        task = orjson.loads(r.content)
+        if task["status"] == "SUCCEEDED":
+            return runway_video_url(task["output"])
+        if task["status"] in ("FAILED", "CANCELLED"):
+            raise HTTPException(status_code=500, detail=f"Runway task {task['status']}: {task.get('failure', '')}")
+
+        print(f"⏳ Waiting for Runway task {task['id']} ({task['status']})...")
+        delay = min(delay * 1.5, RUNWAY_POLL_MAX_DELAY)
+
+    raise HTTPException(status_code=504, detail="Runway task timed out")
 
 
 # =============================================
-# STEP 5 — EdenAI TTS (MP3)
+# STEP 5 — TTS (MP3): Google Cloud TTS, EdenAI fallback
 # =============================================
-def generate_audio(script, eden_key):
-    url = "https://api.edenai.run/v2/audio/text_to_speech"
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|(?<=[。！？])\s*")
+EDEN_TTS_URL = "https://api.edenai.run/v2/audio/text_to_speech"
+B64_CHUNK = 1 << 16  # multiple of 4, so every slice decodes on its own
+TTS_MAX_BYTES = 4500  # synthesize_speech rejects inputs over 5000 bytes
+
+
+def split_for_tts(script):
+    chunks, current = [], ""
+    for sentence in SENTENCE_RE.split(script):
+        candidate = f"{current} {sentence}" if current else sentence
+        if current and len(candidate.encode()) > TTS_MAX_BYTES:
+            chunks.append(current)
+            candidate = sentence
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def generate_audio_google(script):
+    voice = texttospeech.VoiceSelectionParams(language_code="en-US", name="en-US-Neural2-D")
+    audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.MP3)
+
+    # Raw MP3 bytes straight from the API — MP3 frames concatenate cleanly
+    audio_path = temp_path("audio", "mp3")
+    with open(audio_path, "wb") as f:
+        for chunk in split_for_tts(script):
+            resp = tts_client.synthesize_speech(
+                input=texttospeech.SynthesisInput(text=chunk),
+                voice=voice,
+                audio_config=audio_config,
+            )
+            f.write(resp.audio_content)
+
+    return audio_path
+
+
+async def generate_audio(script, eden_key):
+    if tts_client:
+        return await asyncio.to_thread(generate_audio_google, script)
 
     payload = {
         "providers": "google",
@@ -161,16 +663,18 @@ def generate_audio(script, eden_key):
 
     headers = {"Authorization": f"Bearer {eden_key}"}
 
-    r = requests.post(url, json=payload, headers=headers)
+    r = await upstream_post(EDEN_LIMIT, EDEN_TTS_URL, content=orjson.dumps(payload), headers=headers)
     if r.status_code != 200:
         raise HTTPException(status_code=500, detail=f"EdenAI TTS Error: {r.text}")
 
-    audio_b64 = r.json()["google"]["audio"]
-    audio_bytes = base64.b64decode(audio_b64)
+    audio_b64 = orjson.loads(r.content)["google"]["audio"]
 
-    audio_path = os.path.join(temp_dir, f"audio_{uuid.uuid4().hex}.mp3")
+    # Decode in 4-aligned slices so the full decoded MP3 never sits in memory
+    # next to its base64 text
+    audio_path = temp_path("audio", "mp3")
     with open(audio_path, "wb") as f:
-        f.write(audio_bytes)
+        for i in range(0, len(audio_b64), B64_CHUNK):
+            f.write(base64.b64decode(audio_b64[i:i + B64_CHUNK]))
 
     return audio_path
 
@@ -178,85 +682,495 @@ def generate_audio(script, eden_key):
 # =============================================
 # STEP 6 — Subtitle File (SRT)
 # =============================================
-def create_srt(script):
-    lines = script.split(". ")
-    srt = ""
-    current_time = 0
-
-    for i, line in enumerate(lines):
-        start = f"00:00:{current_time:02d},000"
-        end = f"00:00:{current_time + 2:02d},000"
-        current_time += 2
-        srt += f"{i+1}\n{start} --> {end}\n{line}\n\n"
-
-    path = os.path.join(temp_dir, f"sub_{uuid.uuid4().hex}.srt")
-    with open(path, "w") as f:
-        f.write(srt)
+SUBTITLE_SECONDS = 2
+
+
+def srt_timestamp(ms):
+    h, ms = divmod(ms, 3_600_000)
+    m, ms = divmod(ms, 60_000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d},{ms:03d}"
+
+
+SUBTITLE_MAX_WORDS = 7
+
+
+def subtitle_cues(script):
+    cues = []
+    for sentence in SENTENCE_RE.split(script.strip()):
+        words = sentence.split()
+        for i in range(0, len(words), SUBTITLE_MAX_WORDS):
+            cues.append(" ".join(words[i:i + SUBTITLE_MAX_WORDS]))
+    return cues
+
+
+# With the narration length known, each cue gets a share of it proportional
+# to its text length; without it, fall back to fixed SUBTITLE_SECONDS cues
+def create_srt(script, duration_ms=None):
+    cues = subtitle_cues(script)
+    total_chars = sum(len(cue) for cue in cues) or 1
+
+    parts = []
+    start = elapsed_chars = 0
+    for i, cue in enumerate(cues, 1):
+        if duration_ms:
+            elapsed_chars += len(cue)
+            end = duration_ms * elapsed_chars // total_chars
+        else:
+            end = i * SUBTITLE_SECONDS * 1000
+        parts.append(f"{i}\n{srt_timestamp(start)} --> {srt_timestamp(end)}\n{cue}\n\n")
+        start = end
+
+    path = temp_path("sub", "srt")
+    pathlib.Path(path).write_text("".join(parts), encoding="utf-8")
     return path
 
 
+async def audio_duration_ms(audio_path):
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFPROBE_PATH, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", audio_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+        return int(float(out) * 1000)
+    except (OSError, ValueError):
+        return None
+
+
+SRT_MS_RE = re.compile(r"(\d{2}:\d{2}:\d{2}),(\d{3})")
+
+
+# Browsers only accept WebVTT in <track>; same cues, "." before the milliseconds
+def srt_to_vtt(srt_path):
+    srt = pathlib.Path(srt_path).read_text(encoding="utf-8")
+    vtt_path = os.path.splitext(srt_path)[0] + ".vtt"
+    pathlib.Path(vtt_path).write_text("WEBVTT\n\n" + SRT_MS_RE.sub(r"\1.\2", srt), encoding="utf-8")
+    return vtt_path
+
+
 # =============================================
 # STEP 7 — Merge Audio + Subtitles + Video
 # =============================================
-def ffmpeg_merge(video_url, audio_path, srt_path):
-    raw_video_path = os.path.join(temp_dir, f"vid_{uuid.uuid4().hex}.mp4")
-    with open(raw_video_path, "wb") as f:
-        f.write(requests.get(video_url).content)
+# At most FFMPEG_SLOTS encodes per worker, each given an equal share of the cores
+FFMPEG_SLOTS = max(1, (os.cpu_count() or 2) // 2)
+FFMPEG_THREADS = max(1, (os.cpu_count() or 1) // FFMPEG_SLOTS)
+FFMPEG_SEM = asyncio.Semaphore(FFMPEG_SLOTS)
+# Stream-copy merges mostly wait on the network, so they get their own wider cap
+REMUX_SEM = asyncio.Semaphore(8)
+
+# The Runway URL comes from upstream JSON: read it over HTTPS only (never
+# file: or concat:), give up on a read that stalls, and bound the whole run
+REMOTE_INPUT_ARGS = [
+    "-protocol_whitelist", "https,tls,tcp",
+    "-rw_timeout", str(30 * 1_000_000),  # microseconds
+    "-reconnect", "1",
+]
+FFMPEG_TIMEOUT = int(os.getenv("FFMPEG_TIMEOUT", "300"))
+
+
+async def detect_video_encoder():
+    if HWENC in ("nvenc", "vaapi", "x264"):
+        return HWENC
+
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-encoders",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        out, _ = await proc.communicate()
+    except OSError:
+        return "x264"
+
+    # Stock ffmpeg builds list nvenc/vaapi even without the hardware, so check the device too
+    encoders = out.decode(errors="replace")
+    if "h264_nvenc" in encoders and os.path.exists("/dev/nvidia0"):
+        return "nvenc"
+    if "h264_vaapi" in encoders and os.path.exists(VAAPI_DEVICE):
+        return "vaapi"
+    return "x264"
+
+
+@app.on_event("startup")
+async def probe_video_encoder():
+    app.state.video_encoder = await detect_video_encoder()
+    print("🎞️ Video encoder:", app.state.video_encoder)
 
-    final_path = os.path.join(temp_dir, f"final_{uuid.uuid4().hex}.mp4")
 
+def encoder_args(srt_path):
+    subtitles = f"subtitles='{srt_path}'"
+    encoder = app.state.video_encoder
+
+    if encoder == "nvenc":
+        return [], ["-vf", subtitles, "-c:v", "h264_nvenc", "-preset", "p4", "-tune", "ll"]
+    if encoder == "vaapi":
+        # Subtitles are burned on CPU frames, then uploaded for the GPU encode
+        return (
+            ["-vaapi_device", VAAPI_DEVICE],
+            ["-vf", f"{subtitles},format=nv12,hwupload", "-c:v", "h264_vaapi"],
+        )
+    return [], [
+        "-vf", subtitles,
+        "-c:v", "libx264",
+        "-preset", "ultrafast",
+        "-tune", "zerolatency,fastdecode",
+        "-crf", "23",
+        "-threads", str(FFMPEG_THREADS),
+    ]
+
+
+async def ffmpeg_merge(video_url, audio_path, srt_path, burn_subtitles=True):
+    final_path = temp_path("final", "mp4")
+
+    if not burn_subtitles:
+        # No overlay to draw — remux the Runway stream untouched; the captions
+        # ride along as a soft track so the downloaded MP4 still has them
+        cmd = [
+            FFMPEG_PATH,
+            *REMOTE_INPUT_ARGS,
+            "-i", video_url,
+            "-i", audio_path,
+            "-i", srt_path,
+            "-map", "0:v:0",
+            "-map", "1:a:0",
+            "-map", "2:s:0",
+            "-c:v", "copy",
+            "-c:a", "aac",
+            "-c:s", "mov_text",
+            "-movflags", "+faststart",
+            "-shortest",
+            final_path
+        ]
+        return await run_ffmpeg(cmd, final_path, REMUX_SEM)
+
+    # ffmpeg reads the Runway URL itself (HTTP range requests keep the MP4
+    # seekable), so the clip is never buffered or written to disk by us
+    global_args, video_args = encoder_args(srt_path)
     cmd = [
         FFMPEG_PATH,
-        "-i", raw_video_path,
+        *global_args,
+        *REMOTE_INPUT_ARGS,
+        "-i", video_url,
         "-i", audio_path,
-        "-vf", f"subtitles='{srt_path}'",
-        "-c:v", "libx264",
+        *video_args,
         "-c:a", "aac",
+        # moov atom up front so the browser can start playback before the download ends
+        "-movflags", "+faststart",
         "-shortest",
         final_path
     ]
 
-    subprocess.run(cmd, check=True)
+    return await run_ffmpeg(cmd, final_path, FFMPEG_SEM)
+
+
+async def run_ffmpeg(cmd, final_path, sem):
+    # Run ffmpeg as a child process so the event loop keeps serving requests
+    async with sem:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            _, err = await asyncio.wait_for(proc.communicate(), FFMPEG_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=f"ffmpeg timed out after {FFMPEG_TIMEOUT}s")
+        finally:
+            # Timed out or cancelled — don't leave the child or its partial output behind
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+                if os.path.exists(final_path):
+                    os.remove(final_path)
+    if proc.returncode:
+        if os.path.exists(final_path):
+            os.remove(final_path)
+        raise HTTPException(status_code=500, detail=f"ffmpeg Error: {err.decode(errors='replace')[-500:]}")
+
     return final_path
 
 
+# =============================================
+# Response Cache
+# =============================================
+def request_cache_key(data):
+    raw = "|".join(
+        part.strip().lower() for part in (data.device_name, data.purpose, data.language)
+    ) + f"|burn={data.burn_subtitles}"
+    return hashlib.blake2b(raw.encode()).hexdigest()
+
+
+def cached_result(cache_key):
+    cached = CACHE.get(cache_key)
+    if cached and os.path.exists(os.path.join(temp_dir, os.path.basename(cached["video_url"]))):
+        return cached
+    return None
+
+
+# =============================================
+# Pipeline (everything after the script)
+# =============================================
+# =============================================
+# In-flight request coalescing (per worker)
+# =============================================
+INFLIGHT = {}
+
+
+async def coalesced(key, make):
+    # Identical concurrent work shares one task; shield keeps it running for
+    # the other waiters if the caller that started it disconnects
+    task = INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(make())
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def build_result(research, script, compliance=None, burn_subtitles=False):
+    # Finished media is named after the script, so a repeated script reuses it
+    # and skips Runway, TTS and ffmpeg entirely
+    media_key = hashlib.sha1(f"{script}|burn={burn_subtitles}".encode()).hexdigest()
+    return await coalesced(
+        f"media:{media_key}",
+        lambda: render_result(media_key, research, script, compliance, burn_subtitles),
+    )
+
+
+async def render_result(media_key, research, script, compliance, burn_subtitles):
+    final_path = os.path.join(temp_dir, f"final_{media_key}.mp4")
+    vtt_path = os.path.join(temp_dir, f"sub_{media_key}.vtt")
+    media_ready = os.path.exists(final_path) and (burn_subtitles or os.path.exists(vtt_path))
+
+    if media_ready:
+        if compliance is None:
+            compliance = await validate_compliance(script, research, GEMINI_API_KEY)
+    else:
+        # Video and audio only depend on the script — start them first so they run
+        # while compliance is checked (unless already known)
+        srt_path = None
+        video_task = asyncio.create_task(generate_gen2_video(script, RUNWAY_API_KEY))
+        audio_task = asyncio.create_task(generate_audio(script, EDEN_API_KEY))
+        try:
+            if compliance is None:
+                compliance = await validate_compliance(script, research, GEMINI_API_KEY)
+
+            # Subtitles are timed against the real narration, still inside the video wait
+            audio_path = await audio_task
+            srt_path = await asyncio.to_thread(create_srt, script, await audio_duration_ms(audio_path))
+            video_url = await video_task
+
+            # Render under a unique name, then move into place atomically
+            merged_path = await ffmpeg_merge(video_url, audio_path, srt_path, burn_subtitles)
+            if not burn_subtitles:
+                os.replace(await asyncio.to_thread(srt_to_vtt, srt_path), vtt_path)
+            os.replace(merged_path, final_path)
+        finally:
+            # If any step failed, stop the other task (no Runway polling for a
+            # result nobody will use) and collect its outcome
+            for task in (video_task, audio_task):
+                task.cancel()
+            _, audio_result = await asyncio.gather(video_task, audio_task, return_exceptions=True)
+
+            # The narration and SRT are inside the final MP4 / VTT by now, or
+            # the render failed — either way they are done with
+            for path in (audio_result, srt_path):
+                if isinstance(path, str) and os.path.exists(path):
+                    os.remove(path)
+
+    result = {
+        "script": script,
+        "research_used": research,
+        "compliance_passed": compliance,
+        "video_url": f"{VIDEO_BASE_URL}/{os.path.basename(final_path)}",
+    }
+    if not burn_subtitles:
+        result["subtitles_url"] = f"{VIDEO_BASE_URL}/{os.path.basename(vtt_path)}"
+    return result
+
+
 # =============================================
 # API Route
 # =============================================
 @app.post("/generate")
-def generate(data: RequestData):
-
-    research = fetch_research(data.device_name)
-    script = generate_script(data.device_name, data.purpose, research, data.language, GEMINI_API_KEY)
-    compliance = validate_compliance(script, research, GEMINI_API_KEY)
-
-    video_url = generate_gen2_video(script, RUNWAY_API_KEY)
-    audio_path = generate_audio(script, EDEN_API_KEY)
-    srt_path = create_srt(script)
-    final_video = ffmpeg_merge(video_url, audio_path, srt_path)
-
-    hostname = os.getenv("RENDER_EXTERNAL_HOSTNAME")
-    public_url = (
-        f"https://{hostname}/videos/{os.path.basename(final_video)}"
-        if hostname else f"/videos/{os.path.basename(final_video)}"
-=======
-# ======================================
-# Main Route
-# ======================================
-@app.post("/generate")
-def generate(data: RequestData):
+async def generate(data: RequestData):
+
+    cache_key = request_cache_key(data)
+    cached = cached_result(cache_key)
+    if cached:
+        return cached
+
+    return await coalesced(f"generate:{cache_key}", lambda: run_generate(data, cache_key))
+
+
+async def run_generate(data, cache_key):
+    research = await asyncio.to_thread(fetch_research, data.device_name)
+    script, compliance = await generate_script(
+        data.device_name, data.purpose, research, data.language, GEMINI_API_KEY
+    )
+
+    result = await build_result(research, script, compliance, data.burn_subtitles)
+    CACHE.set(cache_key, result, expire=CACHE_TTL)
+    return result
+
+
+# =============================================
+# Job Routes (script now, video in the background)
+# =============================================
+async def run_video_job(job_id, cache_key, research, script, compliance, burn_subtitles):
+    try:
+        result = await build_result(research, script, compliance, burn_subtitles)
+    except Exception as exc:
+        print(f"\n❌ VIDEO JOB {job_id} FAILED:")
+        traceback.print_exc()
+        JOBS.set(job_id, {
+            "status": "failed",
+            "script": script,
+            "research_used": research,
+            "error": getattr(exc, "detail", str(exc)),
+        }, expire=JOB_TTL)
+        return
+
+    CACHE.set(cache_key, result, expire=CACHE_TTL)
+    JOBS.set(job_id, {"status": "done", **result}, expire=JOB_TTL)
+
+
+@app.post("/jobs")
+async def create_job(data: RequestData, background_tasks: BackgroundTasks):
+
+    job_id = uuid.uuid4().hex
+    cache_key = request_cache_key(data)
+    cached = cached_result(cache_key)
+    if cached:
+        job = {"status": "done", **cached}
+        JOBS.set(job_id, job, expire=JOB_TTL)
+        return {"job_id": job_id, **job}
+
+    research = await asyncio.to_thread(fetch_research, data.device_name)
+    script, compliance = await generate_script(
+        data.device_name, data.purpose, research, data.language, GEMINI_API_KEY
+    )
+
+    job = {"status": "pending", "script": script, "research_used": research}
+    JOBS.set(job_id, job, expire=JOB_TTL)
+    background_tasks.add_task(
+        run_video_job, job_id, cache_key, research, script, compliance, data.burn_subtitles
+    )
+    return {"job_id": job_id, **job}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job
+
+
+# =============================================
+# Streaming Script Route (Server-Sent Events)
+# =============================================
+def sse_event(event, data):
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
 
-    script = generate_script(data.device_name, data.purpose, data.language)
-    video_path = generate_video_with_audio(script)
+@app.post("/generate_stream")
+async def generate_stream(data: RequestData):
 
-    hostname = os.getenv("RENDER_EXTERNAL_HOSTNAME")
-    video_url = (
-        f"https://{hostname}/videos/{os.path.basename(video_path)}"
-        if hostname
-        else f"/videos/{os.path.basename(video_path)}"
+    research = await asyncio.to_thread(fetch_research, data.device_name)
+    prompt = SCRIPT_TEMPLATE.format(
+        research=research, device=data.device_name, purpose=data.purpose, language=data.language
     )
 
-    return {"script": script, "video_url": video_url}
+    async def events():
+        parts = []
+        try:
+            async for text in stream_gemini(prompt, GEMINI_API_KEY, SCRIPT_GUIDELINES):
+                parts.append(text)
+                yield sse_event("token", {"text": text})
+        except HTTPException as exc:
+            # Headers are already sent — report the failure in-band
+            yield sse_event("error", {"error": exc.detail})
+            return
+        yield sse_event("done", {"script": "".join(parts).strip(), "research_used": research})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# =============================================
+# Batch Route
+# =============================================
+# One batch is one Gemini prompt and one open connection waiting on every
+# render, so it stays small; larger batches are rejected with a 422
+BATCH_MAX_ITEMS = 20
+BATCH_MAX_CONCURRENCY = 5
+
+
+class BatchRequest(BaseModel):
+    items: list[RequestData] = Field(min_length=1, max_length=BATCH_MAX_ITEMS)
+
+
+@app.post("/generate_batch")
+async def generate_batch(batch: BatchRequest):
+
+    keys = [request_cache_key(item) for item in batch.items]
+    results = [cached_result(key) for key in keys]
+    pending = [i for i, result in enumerate(results) if result is None]
+
+    if pending:
+        items = [batch.items[i] for i in pending]
+        researches = await asyncio.gather(*(
+            asyncio.to_thread(fetch_research, item.device_name) for item in items
+        ))
+
+        # Batch scripts go into the script cache too, so retrying a partly
+        # failed batch reuses them and the finished videos they name
+        script_keys = [
+            script_cache_key(item.device_name, item.purpose, research, item.language)
+            for item, research in zip(items, researches)
+        ]
+        scripts = [CACHE.get(key) for key in script_keys]
+        missing = [j for j, script in enumerate(scripts) if script is None]
+        if missing:
+            fresh_scripts = await generate_scripts_batch(
+                [items[j] for j in missing], [researches[j] for j in missing], GEMINI_API_KEY
+            )
+            for j, script in zip(missing, fresh_scripts):
+                if script is not None:
+                    scripts[j] = (script, None)
+                    CACHE.set(script_keys[j], scripts[j], expire=CACHE_TTL)
+
+        sem = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+        # Each item is cached as soon as it finishes, and a failure is
+        # reported in its own slot instead of failing the whole batch
+        async def run(i, item, research, entry):
+            try:
+                async with sem:
+                    if entry is None:
+                        entry = await generate_script(
+                            item.device_name, item.purpose, research, item.language, GEMINI_API_KEY
+                        )
+                    script, compliance = entry
+                    result = await build_result(research, script, compliance, item.burn_subtitles)
+            except Exception as exc:
+                print(f"\n❌ BATCH ITEM {i} FAILED:")
+                traceback.print_exc()
+                return {"error": getattr(exc, "detail", str(exc))}
+            CACHE.set(keys[i], result, expire=CACHE_TTL)
+            return result
+
+        fresh = await asyncio.gather(*(
+            run(i, item, research, entry)
+            for i, item, research, entry in zip(pending, items, researches, scripts)
+        ))
+        for i, result in zip(pending, fresh):
+            results[i] = result
+
+    return {"results": results}
+
 
 # =============================================
 # Serve Frontend (Vite build)
@@ -267,17 +1181,79 @@ frontend_path = os.path.abspath(
 
 print("Frontend path resolved to:", frontend_path)
 
+PRECOMPRESSED = (("br", ".br"), ("gzip", ".gz"))
+
+
+def accept_encoding_q(header):
+    # "gzip;q=0.5, br" -> {"gzip": 0.5, "br": 1.0}
+    weights = {}
+    for token in header.split(","):
+        name, *params = token.split(";")
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name.strip():
+            weights[name.strip().lower()] = q
+    return weights
+
+
+# Serves the .br/.gz siblings written at build time when the browser accepts
+# them; hashed Vite assets are cached forever, index.html is revalidated
+class FrontendStaticFiles(StaticFiles):
+    async def get_response(self, path, scope):
+        if path.startswith("assets/"):
+            weights = accept_encoding_q(Headers(scope=scope).get("accept-encoding", ""))
+            for encoding, ext in PRECOMPRESSED:
+                # q=0 refuses an encoding; "*" covers any not listed by name
+                if weights.get(encoding, weights.get("*", 0)) <= 0:
+                    continue
+                try:
+                    response = await super().get_response(path + ext, scope)
+                except StarletteHTTPException:
+                    continue
+                response.headers["Content-Encoding"] = encoding
+                response.headers["Vary"] = "Accept-Encoding"
+                response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+                return response
+
+        response = await super().get_response(path, scope)
+        if path.startswith("assets/"):
+            # The identity copy varies too, or a shared cache hands it to everyone
+            response.headers["Vary"] = "Accept-Encoding"
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+        return response
 
-# Frontend
-frontend_path = os.path.abspath(
-    os.path.join(os.path.dirname(__file__), "../frontend/dist")
-)
 
 if os.path.isdir(frontend_path):
-    app.mount("/", StaticFiles(directory=frontend_path, html=True), name="frontend")
+    app.mount("/", FrontendStaticFiles(directory=frontend_path, html=True), name="frontend")
 
     @app.get("/")
     async def serve_index():
         return FileResponse(os.path.join(frontend_path, "index.html"))
 else:
     print("❌ FRONTEND DIST NOT FOUND AT:", frontend_path)
+
+
+# =============================================
+# Local entrypoint (Render uses the uvicorn CLI in render.yaml)
+# =============================================
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", "2")),
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=30,
+    )
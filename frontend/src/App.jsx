@@ -203,7 +203,17 @@ Language: ${language.toUpperCase()}
 
                 {result.video_url ? (
                   <>
-                    <video src={result.video_url} controls />
+                    <video src={result.video_url} controls>
+                      {result.subtitles_url && (
+                        <track
+                          kind="subtitles"
+                          src={result.subtitles_url}
+                          srcLang={language}
+                          label="Subtitles"
+                          default
+                        />
+                      )}
+                    </video>
 
                     <button
                       style={{